@@ -1,92 +1,187 @@
+import http.client
+import os
+import shutil
+import tempfile
+import time
+import urllib.request
+from functools import lru_cache
+
 import pandas as pd
-import numpy as np
 import plotly.express as px
-from dash import Dash, dcc, html, dash_table, callback, Output, Input
+from dash import (Dash, dcc, html, dash_table, callback, 
+                  clientside_callback, Output, Input, State)
 
+# Use Copy-on-Write, so that the derived DataFrames below share data with 
+# the frames they come from until a column is changed. It is always on 
+# from pandas 3.0, where setting the option is deprecated.
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
-# Load and inspect the data using read_csv and head
+# Location of the dataset on the LA data portal, and of the local copy of 
+# the CSV that is reused until it is older than lahd_cache_max_age seconds. 
+# The LAHD_CACHE environment variable overrides the path of the copy.
 lahd_url = "https://data.lacity.org/api/views/mymu-zi3s/"
 lahd_url += "rows.csv?accessType=DOWNLOAD&bom=true&format=true"
-lahd = pd.read_csv(lahd_url)
+lahd_cache = os.environ.get('LAHD_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'lahd', 'lahd.csv'))
+lahd_cache_max_age = 24 * 60 * 60
+lahd_download_timeout = 60
+
+# Columns of the CSV that are read; the other columns are never used.
+lahd_columns = ['PROJECT NUMBER', 'DEVELOPMENT STAGE', 'CONSTRUCTION TYPE', 
+                'SITE UNITS', 'PROJECT TOTAL UNITS', 'HOUSING TYPE', 
+                'SUPPORTIVE HOUSING', 'DATE FUNDED', 'LAHD FUNDED', 
+                'LEVERAGE', 'TAX EXEMPT CONDUIT BOND', 'TDC', 'JOBS', 
+                'DATE STAMP', 'SITE LONGITUDE', 'SITE LATITUDE']
+
+# Read the values of the following columns as category type.
+categorical_columns = ['PROJECT NUMBER', 'DEVELOPMENT STAGE', 
+                       'CONSTRUCTION TYPE', 'HOUSING TYPE', 
+                       'SUPPORTIVE HOUSING']
+lahd_dtypes = {col: 'category' for col in categorical_columns}
+
+
+def load_lahd():
+    """Read the LAHD dataset, downloading the CSV only if the cached copy 
+    is missing or stale. A stale copy is still used when the download 
+    fails, and the CSV is read straight from the portal when no copy can 
+    be written."""
+    try:
+        age = time.time() - os.path.getmtime(lahd_cache)
+    except OSError:
+        age = None
+    source = lahd_cache
+    if age is None or age > lahd_cache_max_age:
+        tmp = None
+        try:
+            cache_dir = os.path.dirname(lahd_cache)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Download to a temporary file first so that a partial download 
+            # never replaces a good copy.
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.part')
+            with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(
+                    lahd_url, timeout=lahd_download_timeout) as response:
+                shutil.copyfileobj(response, f)
+            os.replace(tmp, lahd_cache)
+        except (OSError, http.client.HTTPException):
+            # Without any copy to fall back on, read the portal directly.
+            if age is None:
+                source = lahd_url
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+    # The numeric columns are formatted with thousands separators, and 
+    # DATE FUNDED as month/day/year; both are parsed while reading.
+    return pd.read_csv(source, usecols=lahd_columns, thousands=',', 
+                       dtype=lahd_dtypes, 
+                       parse_dates=['DATE FUNDED'], date_format='%m/%d/%Y')
+
+
+# Load the data
+lahd = load_lahd()
+
+# A value that cannot be parsed, such as TBD, leaves its whole column as 
+# text. Convert such columns again and turn the bad values into missing 
+# values, so that only the affected projects are dropped below.
+numeric_columns = ['SITE UNITS', 'PROJECT TOTAL UNITS', 'LAHD FUNDED', 
+                   'LEVERAGE', 'TAX EXEMPT CONDUIT BOND', 'TDC', 'JOBS', 
+                   'SITE LONGITUDE', 'SITE LATITUDE']
+for col in numeric_columns:
+    if not pd.api.types.is_numeric_dtype(lahd[col]):
+        lahd[col] = pd.to_numeric(lahd[col].str.replace(',', '', regex=False), 
+                                  errors='coerce')
+if not pd.api.types.is_datetime64_any_dtype(lahd['DATE FUNDED']):
+    lahd['DATE FUNDED'] = pd.to_datetime(lahd['DATE FUNDED'], 
+                                         format='%m/%d/%Y', errors='coerce')
+
+# Store the site coordinates as float32, which is precise to about a metre.
+coordinates = ['SITE LONGITUDE', 'SITE LATITUDE']
+lahd[coordinates] = lahd[coordinates].astype('float32')
 
 # Store the date stamp
 date_stamp = lahd['DATE STAMP'][0][:10]
 
 # Remove rows with CONSTRUCTION TYPE value AQUISITION ONLY, and with 
-# HOUSING TYPE value AT-RISK
-lahd = lahd.loc[lahd['CONSTRUCTION TYPE'] != 'ACQUISITION ONLY', :]
-lahd = lahd.loc[lahd['HOUSING TYPE'] != 'AT-RISK', :]
-
-# Rename some columns
-lahd.rename(columns={'TDC': 'TOTAL DEVELOPMENT COST', 
-                     'SITE #': 'SITE NUMBER'}, 
-            inplace=True)
-
-# Convert data values of the columns LAHD FUNDED, LEVERAGE, 
-# TAX EXEMPT CONDUIT BOND, TOTAL DEVELOPMENT COST, and JOBS 
-# to float or integer type.
-numeric_columns = ['LAHD FUNDED', 'LEVERAGE', 
-                   'TAX EXEMPT CONDUIT BOND', 'TOTAL DEVELOPMENT COST']
-lahd[numeric_columns] = lahd[numeric_columns].replace(',', '', regex=True)
-lahd[numeric_columns] = lahd[numeric_columns].apply(pd.to_numeric, 
-                                                    downcast='float', 
-                                                    errors='coerce')
-lahd[['JOBS']] = lahd[['JOBS']].apply(pd.to_numeric, downcast='integer', 
-                                      errors='coerce')
-
-# Convert the values of the following columns to category type. 
-categorical_columns = ['APN', 'PROJECT NUMBER', 'DEVELOPMENT STAGE', 
-                       'CONSTRUCTION TYPE', 'SITE NUMBER', 'HOUSING TYPE', 
-                       'SUPPORTIVE HOUSING', 'IN-SERVICE DATE']
-lahd[categorical_columns] = lahd[categorical_columns].astype('category')
-
-# Convert the values of the column DATE FUNDED to Datetime type.
-lahd['DATE FUNDED'] = pd.to_datetime(lahd['DATE FUNDED'], 
-                                     format="%m/%d/%Y", errors='coerce')
-
-# Group Affordable Housing Projects dataset by PROJECT NUMBER. 
-# Use count to count the number of sites per project.
-project_count = lahd.groupby('PROJECT NUMBER')['PROJECT NUMBER'].count()
-
-# Drop rows with duplicated values in PROJECT NUMBER, and sort the resulting 
-# dataset by PROJECT NUMBER. Assign the dataset to DataFrame lahd_projects.
-lahd_projects = lahd.drop_duplicates(
-    ['PROJECT NUMBER']).sort_values('PROJECT NUMBER')
-
-# Add columns NUMBER OF SITES, YEAR FUNDED, and COST PER HOUSING UNIT
-lahd_projects['NUMBER OF SITES'] = np.array(project_count)
-lahd_projects['DATE FUNDED'] = lahd_projects['DATE FUNDED'].astype(str)
-lahd_projects['YEAR FUNDED'] = lahd_projects['DATE FUNDED'].apply(
-    lambda d: d[:4])
-lahd_projects['DATE FUNDED'] = lahd_projects['DATE FUNDED'].apply(
-    lambda d: d[:10])
-lahd_projects['YEAR FUNDED'] = pd.to_datetime(lahd_projects['YEAR FUNDED'], 
-                                              format="%Y", errors='coerce')
+# HOUSING TYPE value AT-RISK, in a single pass. Both columns are already 
+# categorical, so the comparisons are made on the category codes.
+lahd = lahd.loc[(lahd['CONSTRUCTION TYPE'] != 'ACQUISITION ONLY') & 
+                (lahd['HOUSING TYPE'] != 'AT-RISK'), :]
+
+# Remove the categories that no longer occur, such as the two above and 
+# the PROJECT NUMBER values of the removed projects.
+for col in categorical_columns:
+    lahd[col] = lahd[col].cat.remove_unused_categories()
+
+# Rename the column TDC
+lahd = lahd.rename(columns={'TDC': 'TOTAL DEVELOPMENT COST'})
+
+# Count the number of sites per project in the Affordable Housing Projects 
+# dataset.
+site_counts = lahd['PROJECT NUMBER'].value_counts()
+
+# Drop rows with duplicated values in PROJECT NUMBER. Assign the dataset to 
+# DataFrame lahd_projects.
+lahd_projects = lahd.drop_duplicates(['PROJECT NUMBER'])
+
+# Add columns NUMBER OF SITES, YEAR FUNDED, and COST PER HOUSING UNIT. The 
+# site counts are looked up by PROJECT NUMBER, so they do not depend on 
+# the order of the rows.
+lahd_projects['NUMBER OF SITES'] = lahd_projects['PROJECT NUMBER'].map(
+    site_counts).astype('int16')
+# DATE FUNDED stays a Datetime column; YEAR FUNDED holds its year as a 
+# small integer, which is cheaper to group by than a Timestamp.
+lahd_projects['YEAR FUNDED'] = lahd_projects['DATE FUNDED'].dt.year.astype(
+    'Int16')
 tdc = lahd_projects['TOTAL DEVELOPMENT COST']
 ptu = lahd_projects['PROJECT TOTAL UNITS']
 lahd_projects['COST PER HOUSING UNIT'] = tdc / ptu
 
-# Drop the following columns from lahd_projects.
-lahd_projects.drop(['APN', 'NAME', 'SITE ADDRESS', 'SITE NUMBER', 
-                    'SITE COMMUNITY', 'SITE UNITS','SH UNITS PER SITE', 
-                    'IN-SERVICE DATE', 'PHOTO', 'PROJECT SUMMARY URL', 
-                    'CONTRACT NUMBERS', 'DATE STAMP', 'SITE LONGITUDE', 
-                    'SITE LATITUDE', 'GPS_COORDS ON MAP', 'DEVELOPER', 
-                    'MANAGEMENT COMPANY', 'CONTACT PHONE'], 
-          axis='columns', inplace=True)
+# Drop the following columns from lahd_projects, and then all rows with 
+# missing values. JOBS was converted to numbers above, and without 
+# missing values it fits a plain int32.
+lahd_projects = lahd_projects.drop(columns=['SITE UNITS', 'DATE STAMP', 
+                                            'SITE LONGITUDE', 
+                                            'SITE LATITUDE']).dropna()
+lahd_projects['JOBS'] = lahd_projects['JOBS'].astype('int32')
 
-# Drop the column SITE COUNCIL DISTRICT from lahd_projects
-lahd_projects.drop(lahd_projects.columns[3], 
-                   axis='columns', inplace=True)
+# Build the records shown in the DataTable once, sorted by PROJECT NUMBER. 
+# DATE FUNDED is formatted as text and the cost per unit is rounded to 
+# cents, so the records hold plain strings and short floats instead of 
+# Timestamps.
+cphu = lahd_projects['COST PER HOUSING UNIT']
+table_records = lahd_projects.sort_values('PROJECT NUMBER').assign(**{
+    'DATE FUNDED': lahd_projects['DATE FUNDED'].dt.strftime('%Y-%m-%d'),
+    'COST PER HOUSING UNIT': cphu.round(2)
+}).to_dict('records')
 
-# Create a new DataFrame with the JOBS column dropped.
-lahd_projects_no_jobs_column = lahd_projects.drop(['JOBS'], 
-                                                  axis='columns')
+# Sites shown on the map. Sites without coordinates cannot be placed, so 
+# they are dropped once here rather than sent with every map figure.
+lahd_sites = lahd.dropna(subset=['SITE LATITUDE', 'SITE LONGITUDE'])
 
-# Drop all rows with missing values in both lahd_projects and 
-# lahd_projects_no_jobs_column
-lahd_projects.dropna(inplace=True)
-lahd_projects_no_jobs_column.dropna(inplace=True)
+# The bar plot of TOTAL DEVELOPMENT COST only has three selections. Its 
+# figures are built once here and sent to the browser with the layout, 
+# which switches between them without calling back to the server.
+def plot1_figure(column_selected):
+    # Sum the costs per year and category, so that the plot gets one bar 
+    # segment per year and category rather than one per project. The bars 
+    # are placed by year, so the groups do not need to be sorted.
+    costs = lahd_projects.groupby(['YEAR FUNDED', column_selected], 
+                                  observed=True, sort=False, 
+                                  as_index=False).agg(**{
+        'TOTAL DEVELOPMENT COST': ('TOTAL DEVELOPMENT COST', 'sum'),
+        'NUMBER OF PROJECTS': ('PROJECT NUMBER', 'size')
+    })
+    fig = px.bar(costs, x="YEAR FUNDED", y="TOTAL DEVELOPMENT COST", 
+                 color=column_selected, barmode='stack', 
+                 hover_data={"TOTAL DEVELOPMENT COST": True, 
+                             column_selected: True, 
+                             "NUMBER OF PROJECTS": True},
+                 title=f"TOTAL COST and {column_selected} by YEAR FUNDED")
+    return fig
+
+plot1_figures = {column: plot1_figure(column).to_plotly_json() 
+                 for column in ['HOUSING TYPE', 'CONSTRUCTION TYPE', 
+                                'SUPPORTIVE HOUSING']}
 
 app = Dash(__name__)
 server = app.server
@@ -102,7 +197,7 @@ section1 = [
     # Display a table of the data
     html.H2("LAHD Affordable Housing Project Dataset", 
             style={'color': 'darkblue'}),
-    dash_table.DataTable(data=lahd_projects.to_dict('records'), page_size=8),
+    dash_table.DataTable(data=table_records, page_size=8),
     html.Hr(),
     
     # Display a bar plot of TOTAL DEVELOPMENT COST. Create a radio 
@@ -114,6 +209,7 @@ section1 = [
                             'SUPPORTIVE HOUSING'], 
                    value='HOUSING TYPE', id='plot1_input'),
     dcc.Graph(figure={}, id='plot1_output'),
+    dcc.Store(data=plot1_figures, id='plot1_figures'),
     html.Hr(),
 ]
 
@@ -199,20 +295,23 @@ section4 = [
 app.layout = html.Div(section1 + section2 + section3 + section4, 
                       style={'font-family': 'system-ui'})
 
-# Define the callback function for the bar plot of TOTAL DEVELOPMENT COST
-@callback(
+# Define the callback function for the bar plot of TOTAL DEVELOPMENT COST. 
+# It runs in the browser and returns a copy of the stored figure, because 
+# the graph modifies the figure it is given.
+clientside_callback(
+    """
+    function(column_selected, figures) {
+        return JSON.parse(JSON.stringify(figures[column_selected]));
+    }
+    """,
     Output(component_id='plot1_output', component_property='figure'),
-    Input(component_id='plot1_input', component_property='value')
+    Input(component_id='plot1_input', component_property='value'),
+    State(component_id='plot1_figures', component_property='data')
 )
-def update_graph(column_selected):
-    fig = px.bar(lahd_projects, x="YEAR FUNDED", y="TOTAL DEVELOPMENT COST", 
-                 color=column_selected, barmode='stack', 
-                 hover_data={"TOTAL DEVELOPMENT COST": True, 
-                             column_selected: True, 
-                             "DATE FUNDED": True, "YEAR FUNDED": False, 
-                             "PROJECT NUMBER": True},
-                 title=f"TOTAL COST and {column_selected} by YEAR FUNDED")
-    return fig
+
+# The other plots have too many selections to send all of their figures 
+# with the layout. The data never changes while the app is running, so 
+# their callbacks keep the figures they have built in an lru_cache.
 
 # Define the callback function for the scatter plot of the funding source, 
 # project metric, and housing category.
@@ -222,6 +321,7 @@ def update_graph(column_selected):
     Input(component_id='plot2_input2', component_property='value'),
     Input(component_id='plot2_input3', component_property='value')
 )
+@lru_cache(maxsize=128)
 def update_graph(column1_selected, column2_selected, column3_selected):
     t = f"{column1_selected} versus {column2_selected} by {column3_selected}"
     fig = px.scatter(lahd_projects, x=column2_selected, y=column1_selected, 
@@ -236,6 +336,7 @@ def update_graph(column1_selected, column2_selected, column3_selected):
     Input(component_id='plot2_input', component_property='value'), 
     Input(component_id='plot2_input2', component_property='value')
 )
+@lru_cache(maxsize=128)
 def update_graph(column1_selected, column2_selected):
     t = f"{column1_selected} versus {column2_selected}"
     fig = px.density_heatmap(lahd_projects, x=column2_selected, 
@@ -254,12 +355,13 @@ def update_graph(column1_selected, column2_selected):
     Input(component_id='plot2_input', component_property='value'), 
     Input(component_id='plot2_input2', component_property='value')
 )
+@lru_cache(maxsize=128)
 def update_graph(column1_selected, column2_selected):
     t = f"{column1_selected} and {column2_selected} by YEAR FUNDED"
     fig = px.bar(lahd_projects, x="YEAR FUNDED", y=column1_selected, 
                  color=column2_selected,
                  hover_data={column1_selected: True, column2_selected: True, 
-                             "DATE FUNDED": True, "YEAR FUNDED": False, 
+                             "DATE FUNDED": "|%Y-%m-%d", "YEAR FUNDED": False, 
                              "PROJECT NUMBER": True},
                  title=t)
     return fig
@@ -272,6 +374,7 @@ def update_graph(column1_selected, column2_selected):
     Input(component_id='plot3_input2', component_property='value'),
     Input(component_id='plot3_input3', component_property='value')
 )
+@lru_cache(maxsize=128)
 def update_graph(column1_selected, column2_selected, column3_selected):
     if column3_selected == 'ALL':
         fig = px.box(lahd_projects, y=column2_selected, x=column1_selected,
@@ -293,9 +396,10 @@ def update_graph(column1_selected, column2_selected, column3_selected):
     Input(component_id='plot4_input2', component_property='value'),
     Input(component_id='plot4_input3', component_property='value')
 )
+@lru_cache(maxsize=128)
 def update_graph(column1_selected, column2_selected, map_layout):
     if column2_selected == 'NONE':
-        fig = px.scatter_map(lahd, lat='SITE LATITUDE', 
+        fig = px.scatter_map(lahd_sites, lat='SITE LATITUDE', 
                              lon='SITE LONGITUDE', 
                              center={'lat': 34.088, 'lon': -118.353}, 
                              color=column1_selected,
@@ -304,8 +408,10 @@ def update_graph(column1_selected, column2_selected, map_layout):
                              title=f"Affordable Housing by {column1_selected}")
     else:
         t = f"Affordable Housing by {column1_selected} and {column2_selected}"
-        fig = px.scatter_map(lahd, lat='SITE LATITUDE', 
-                             lon='SITE LONGITUDE', 
+        # Plotly rejects missing marker sizes, so sites without a value for 
+        # the selected metric are left off this map.
+        fig = px.scatter_map(lahd_sites.dropna(subset=[column2_selected]), 
+                             lat='SITE LATITUDE', lon='SITE LONGITUDE', 
                              center={'lat': 34.088, 'lon': -118.353}, 
                              color=column1_selected, size=column2_selected,
                              hover_name="PROJECT NUMBER",